@@ -5,6 +5,17 @@ from tkinter import filedialog, messagebox, simpledialog
 from PIL import Image, ImageTk
 import subprocess
 import sys
+import zlib
+import hashlib
+import json
+import time
+import threading
+import queue
+from collections import OrderedDict
+from transfer_stats import (
+    StatsRegistry, PacketTracer, format_stats, EVENT_SEND, EVENT_RESEND,
+    EVENT_ACK_RECEIVED, EVENT_TIMEOUT,
+)
 
 # Client Configuration
 BUFFER_SIZE = 1024
@@ -14,81 +25,204 @@ END_SIGNAL = b"END"
 END_SESSION = b"END_SESSION"
 DELETE_REQUEST = b"DELETE"
 DELETE_FOLDER_REQUEST = b"DELETE_FOLDER"  # New command for folder deletion
+FILE_OK = b"FILE_OK"
+FILE_CORRUPT = b"FILE_CORRUPT"
+ACK_SIZE = 8  # Seq (4) + CRC32 (4)
+FILENAME_RETRIES = 5  # Times the filename is sent before giving up on its ACK
+END_RETRIES = 5  # Times END is sent before giving up on the server's verdict
+MAX_TIMEOUTS = 10  # Timeouts in a row without any ACK before the upload is cancelled
+STATS_REQUEST = b"STATS"  # Asks the server for its live transfer statistics
+STATS_BUFFER_SIZE = 65535
+
+TRACE_FILE = None  # Path of the binary packet trace, None disables tracing
 
 GLOBAL_DIRECTORY = r"Poner la ruta donde se encuentre este documento"
 
+# Preview Configuration
+PREVIEW_CACHE_BYTES = 32 * 1024 * 1024  # Memory used by the decoded previews
+THUMBNAIL_SIZE = (240, 160)
+TEXT_PREVIEW_BYTES = 4096
+PREVIEW_POLL_MS = 50
+
+FILE_TYPES = {
+    '.mp3': "audio", '.wav': "audio",
+    '.mp4': "video", '.avi': "video", '.mov': "video",
+    '.pdf': "pdf",
+    '.txt': "text", '.csv': "text",
+    '.jpg': "image", '.jpeg': "image", '.png': "image",
+}
+
+
+def get_file_type(filename):
+    return FILE_TYPES.get(os.path.splitext(filename)[1].lower())
+
 class Client:
-    def __init__(self, server_ip='localhost', server_port=9000):
+    def __init__(self, server_ip='localhost', server_port=9000, trace_path=TRACE_FILE):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_address = (server_ip, server_port)
         self.client_socket.settimeout(2)
+        self.stats = StatsRegistry(WINDOW_SIZE)
+        self.tracer = PacketTracer(trace_path)
 
     def send_file(self, filepath, folder=""):
+        transfer = None
+        verified = False
         try:
             filename = os.path.join(folder, os.path.basename(filepath)) if folder else os.path.basename(filepath)
             print(f"Attempting to upload file: {filepath}")
             print(f"Destination filename on server: {filename}")
 
-            filename_packet = (0).to_bytes(4, 'big') + filename.encode('utf-8')
-            self.client_socket.sendto(filename_packet, self.server_address)
-            
+            # The filename packet carries its own CRC32 so a corrupted path is never used
+            seq_bytes = (0).to_bytes(4, 'big')
+            filename_data = filename.encode('utf-8')
+            if len(filename_data) > BUFFER_SIZE:
+                raise Exception(f"The file path is longer than {BUFFER_SIZE} bytes.")
+            checksum = zlib.crc32(seq_bytes + filename_data)
+            filename_packet = seq_bytes + checksum.to_bytes(4, 'big') + filename_data
+            if not self.send_filename(filename_packet):
+                raise Exception("Server did not acknowledge the filename.")
+
+            transfer = self.stats.start_transfer(filename)
+
             with open(filepath, 'rb') as file:
                 seq_num = 1
                 window = {}
+                # Send time of each packet, packets that were resent give no RTT sample
+                send_times = {}
+                resent = set()
+                timeouts_in_a_row = 0
+                # The file hash is updated while reading, so the file is only read once
+                file_hash = hashlib.sha256()
 
                 while True:
                     while len(window) < WINDOW_SIZE:
                         data = file.read(BUFFER_SIZE)
                         if not data:
                             break
+                        file_hash.update(data)
 
                         num_fragments = (len(data) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
-                        for fragment_index in range(num_fragments):
-                            fragment_start = fragment_index * FRAGMENT_SIZE
-                            fragment_data = data[fragment_start:fragment_start + FRAGMENT_SIZE]
-
-                            packet = (
-                                seq_num.to_bytes(4, 'big') +
-                                fragment_index.to_bytes(2, 'big') +
-                                num_fragments.to_bytes(2, 'big') +
-                                fragment_data
-                            )
-                            self.client_socket.sendto(packet, self.server_address)
+                        self.send_fragments(seq_num, data, num_fragments, transfer)
 
                         window[seq_num] = (data, num_fragments)
+                        send_times[seq_num] = time.monotonic()
                         seq_num += 1
 
-                    try:
-                        ack, _ = self.client_socket.recvfrom(4)
-                        ack_num = int.from_bytes(ack, 'big')
+                    transfer.window_occupancy.add(len(window))
 
-                        if ack_num in window:
-                            del window[ack_num]
+                    try:
+                        ack, _ = self.client_socket.recvfrom(BUFFER_SIZE)
+                        ack_num = self.parse_ack(ack)
+
+                        if ack_num is None:
+                            # Corrupted ACKs and late replies are ignored, the timeout covers a lost ACK
+                            if len(ack) == ACK_SIZE:
+                                transfer.count("checksum_errors")
+                        else:
+                            transfer.count("acks_received")
+                            self.tracer.record(EVENT_ACK_RECEIVED, ack_num)
+
+                            if ack_num in window:
+                                timeouts_in_a_row = 0
+                                del window[ack_num]
+                                if ack_num not in resent:
+                                    transfer.rtt_ms.add((time.monotonic() - send_times[ack_num]) * 1000)
+                                del send_times[ack_num]
+                                resent.discard(ack_num)
+                            else:
+                                transfer.count("duplicate_acks")
 
                     except socket.timeout:
+                        transfer.count("timeouts")
+                        self.tracer.record(EVENT_TIMEOUT)
+                        timeouts_in_a_row += 1
+                        if timeouts_in_a_row >= MAX_TIMEOUTS:
+                            raise Exception("Server stopped responding, upload cancelled.")
+
                         print("Timeout occurred, resending packets...")
                         for seq, (data, num_fragments) in window.items():
-                            for fragment_index in range(num_fragments):
-                                fragment_start = fragment_index * FRAGMENT_SIZE
-                                fragment_data = data[fragment_start:fragment_start + FRAGMENT_SIZE]
-                                packet = (
-                                    seq.to_bytes(4, 'big') +
-                                    fragment_index.to_bytes(2, 'big') +
-                                    num_fragments.to_bytes(2, 'big') +
-                                    fragment_data
-                                )
-                                self.client_socket.sendto(packet, self.server_address)
+                            self.send_fragments(seq, data, num_fragments, transfer, EVENT_RESEND)
+                            resent.add(seq)
 
                     if not data and not window:
                         break
 
-            self.client_socket.sendto(END_SIGNAL, self.server_address)
-            print(f"File upload completed: {filepath}")
+            # Send the end signal followed by the whole-file hash
+            verified = self.wait_for_verification(END_SIGNAL + file_hash.digest())
+            if verified:
+                print(f"File upload completed: {filepath}")
+            else:
+                print(f"File upload failed the integrity check: {filepath}")
+                messagebox.showerror("Upload Error", f"The server could not verify '{filename}'. The file was not replaced.")
 
         except Exception as e:
             print(f"Error occurred while uploading file: {e}")
             messagebox.showerror("Upload Error", f"Failed to upload file: {e}")
 
+        finally:
+            if transfer:
+                self.stats.finish_transfer(transfer, verified)
+                print(f"Transfer stats: {transfer.summary()}")
+
+    def send_fragments(self, seq_num, data, num_fragments, transfer, event=EVENT_SEND):
+        """Sends every fragment of a packet, each one with its own CRC32 checksum."""
+        for fragment_index in range(num_fragments):
+            fragment_start = fragment_index * FRAGMENT_SIZE
+            fragment_data = data[fragment_start:fragment_start + FRAGMENT_SIZE]
+
+            header = (
+                seq_num.to_bytes(4, 'big') +
+                fragment_index.to_bytes(2, 'big') +
+                num_fragments.to_bytes(2, 'big')
+            )
+            checksum = zlib.crc32(header + fragment_data)
+            packet = header + checksum.to_bytes(4, 'big') + fragment_data
+            self.client_socket.sendto(packet, self.server_address)
+
+            transfer.count("packets_sent")
+            transfer.count("bytes_sent", len(fragment_data))
+            if event == EVENT_RESEND:
+                transfer.count("retransmissions")
+            self.tracer.record(event, seq_num, fragment_index, num_fragments, len(fragment_data))
+
+    def parse_ack(self, packet):
+        """Returns the sequence number of an ACK, or None if it is not a valid ACK."""
+        if len(packet) != ACK_SIZE or zlib.crc32(packet[:4]) != int.from_bytes(packet[4:], 'big'):
+            return None
+        return int.from_bytes(packet[:4], 'big')
+
+    def send_filename(self, filename_packet):
+        """Sends the filename packet until the server answers with ACK #0."""
+        for attempt in range(FILENAME_RETRIES):
+            self.client_socket.sendto(filename_packet, self.server_address)
+            try:
+                while True:
+                    response, _ = self.client_socket.recvfrom(BUFFER_SIZE)
+                    # Late replies from a previous upload may still be queued, skip them
+                    if self.parse_ack(response) == 0:
+                        return True
+            except socket.timeout:
+                print("No ACK for the filename, resending it...")
+        return False
+
+    def wait_for_verification(self, end_packet):
+        """Sends END with the file hash until the server says whether it matched."""
+        for attempt in range(END_RETRIES):
+            self.client_socket.sendto(end_packet, self.server_address)
+            try:
+                while True:
+                    response, _ = self.client_socket.recvfrom(BUFFER_SIZE)
+                    # Late ACKs may still be queued, skip them
+                    if response == FILE_OK:
+                        return True
+                    if response == FILE_CORRUPT:
+                        return False
+            except socket.timeout:
+                print("No verdict from the server, resending end signal...")
+
+        print("Server did not confirm the file integrity.")
+        return False
+
     def delete_file(self, filepath):
         delete_packet = DELETE_REQUEST + filepath.encode('utf-8')
         self.client_socket.sendto(delete_packet, self.server_address)
@@ -109,31 +243,141 @@ class Client:
         except socket.timeout:
             return "Error: Server did not respond to delete folder request."
 
+    def query_stats(self):
+        """Asks the server for its live statistics, returns None if it does not answer."""
+        self.client_socket.sendto(STATS_REQUEST, self.server_address)
+
+        try:
+            while True:
+                response, _ = self.client_socket.recvfrom(STATS_BUFFER_SIZE)
+                # Skip late ACKs or confirmations from a previous upload
+                if response.startswith(b"{"):
+                    return json.loads(response.decode('utf-8'))
+        except socket.timeout:
+            return None
+
     def close_connection(self):
         try:
             self.client_socket.sendto(END_SESSION, self.server_address)
             self.client_socket.close()
+            self.tracer.close()
         except Exception as e:
             print(f"Error closing connection: {e}")
 
+class ThumbnailCache:
+    """LRU cache of decoded previews keyed by path and mtime, bounded by their size in bytes."""
+
+    def __init__(self, max_bytes=PREVIEW_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, mtime):
+        with self.lock:
+            entry = self.entries.get((path, mtime))
+            if entry is None:
+                return None
+            self.entries.move_to_end((path, mtime))
+            return entry[0]
+
+    def put(self, path, mtime, preview, size):
+        with self.lock:
+            old_entry = self.entries.pop((path, mtime), None)
+            if old_entry:
+                self.size -= old_entry[1]
+            self.entries[(path, mtime)] = (preview, size)
+            self.size += size
+
+            # Evict the least recently used previews, always keeping the newest one
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+class PreviewWorker(threading.Thread):
+    """Decodes previews in the background, only the latest request is worth decoding."""
+
+    def __init__(self, cache):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.latest_token = None
+
+    def request(self, token, path, mtime, file_type):
+        self.latest_token = token
+        self.requests.put((token, path, mtime, file_type))
+
+    def stop(self):
+        self.requests.put(None)
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            token, path, mtime, file_type = request
+
+            # Skip the files the user already scrolled past
+            if token != self.latest_token:
+                continue
+
+            preview = self.cache.get(path, mtime)
+            if preview is None:
+                try:
+                    preview, size = self.decode(path, file_type)
+                    self.cache.put(path, mtime, preview, size)
+                except Exception as e:
+                    preview = ("info", f"Could not preview file: {e}")
+            self.results.put((token, preview))
+
+    def decode(self, path, file_type):
+        """Returns the preview of a file and its approximate size in memory."""
+        if file_type == "text":
+            with open(path, 'rb') as file:
+                data = file.read(TEXT_PREVIEW_BYTES)
+            return ("text", data.decode('utf-8', errors='replace')), len(data)
+
+        if file_type == "image":
+            with Image.open(path) as image:
+                # Let JPEG decode at a reduced scale instead of the full resolution
+                image.draft('RGB', THUMBNAIL_SIZE)
+                image.thumbnail(THUMBNAIL_SIZE)
+                thumbnail = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            width, height = thumbnail.size
+            return ("image", thumbnail), width * height * len(thumbnail.getbands())
+
+        # Audio, video, PDF and unknown files only show their details
+        info = f"{os.path.basename(path)}\nType: {file_type or 'unknown'}\nSize: {os.path.getsize(path)} bytes"
+        return ("info", info), len(info)
+
+
 class App(tk.Tk):
     def __init__(self):
         super().__init__()
         self.client = Client()
         self.title("File Manager with Folder Support")
-        self.geometry("600x600")
+        self.geometry("600x800")
+
+        # Icons are loaded the first time a file of that type is previewed
+        self.icons = {}
 
-        self.icons = {
-            "audio": self.load_icon("audio_icon.png"),
-            "video": self.load_icon("video_icon.png"),
-            "pdf": self.load_icon("pdf_icon.png"),
-            "text": self.load_icon("text_icon.png"),
-            "image": self.load_icon("image_icon.png")
-        }
+        self.preview_cache = ThumbnailCache()
+        self.preview_worker = PreviewWorker(self.preview_cache)
+        self.preview_worker.start()
+        self.preview_token = 0
+        self.preview_photo = None
 
         self.folders = {"": []}
         self.selected_folder = ""
         self.filepaths = {"": []}
+        # Local path of every listed file by (folder, filename), kept after the upload
+        self.local_paths = {}
+
+        # What the file listbox shows right now, so it can be updated incrementally
+        self.listbox_folder = None
+        self.listbox_files = []
 
         self.protocol("WM_DELETE_WINDOW", self.on_close)
 
@@ -169,6 +413,20 @@ class App(tk.Tk):
         self.delete_folder_button = tk.Button(self, text="Delete Selected Folder", command=self.delete_selected_folder)
         self.delete_folder_button.pack(pady=5)
 
+        self.stats_button = tk.Button(self, text="Server Stats", command=self.show_server_stats)
+        self.stats_button.pack(pady=5)
+
+        self.after(PREVIEW_POLL_MS, self.poll_previews)
+
+    def show_server_stats(self):
+        """Show the live statistics of the server and of this client's uploads."""
+        stats = self.client.query_stats()
+        if stats is None:
+            messagebox.showerror("Server Stats", "Error: Server did not respond to stats request.")
+            return
+        client_stats = format_stats(self.client.stats.to_dict())
+        messagebox.showinfo("Server Stats", f"Server\n{format_stats(stats)}\n\nClient\n{client_stats}")
+
     def delete_selected_folder(self):
         """Delete the selected folder and all its contents from the server."""
         if self.selected_folder:
@@ -182,6 +440,10 @@ class App(tk.Tk):
                 if "deleted successfully" in result:
                     del self.folders[self.selected_folder]
                     del self.filepaths[self.selected_folder]
+                    self.local_paths = {
+                        key: path for key, path in self.local_paths.items()
+                        if key[0] != self.selected_folder
+                    }
                     self.selected_folder = ""
                     self.update_folder_listbox()
                     self.update_file_listbox()
@@ -197,6 +459,7 @@ class App(tk.Tk):
         return icon
 
     def on_close(self):
+        self.preview_worker.stop()
         self.client.close_connection()
         self.destroy()
 
@@ -220,28 +483,43 @@ class App(tk.Tk):
             index = selection[0]
             self.selected_folder = "" if index == 0 else self.folder_listbox.get(index)
             self.update_file_listbox()
+            # Drop the preview of the previous folder and any result still being decoded for it
+            self.preview_token += 1
+            self.clear_preview()
 
     def update_file_listbox(self):
-        self.file_listbox.delete(0, tk.END)
-        for file in self.folders.get(self.selected_folder, []):
-            icon = self.get_icon_for_file(file)
-            self.file_listbox.insert(tk.END, file)
-            if icon:
-                self.file_listbox.image_create(tk.END, image=icon)
+        files = self.folders.get(self.selected_folder, [])
+
+        if self.listbox_folder != self.selected_folder:
+            # Another folder, rebuild the listbox with a single insert
+            self.file_listbox.delete(0, tk.END)
+            self.file_listbox.insert(tk.END, *files)
+        else:
+            # Same folder, only replace the block of entries that changed
+            old_files = self.listbox_files
+            shortest = min(len(old_files), len(files))
+            prefix = 0
+            while prefix < shortest and old_files[prefix] == files[prefix]:
+                prefix += 1
+            suffix = 0
+            while suffix < shortest - prefix and old_files[-1 - suffix] == files[-1 - suffix]:
+                suffix += 1
+
+            if len(old_files) - suffix > prefix:
+                self.file_listbox.delete(prefix, len(old_files) - suffix - 1)
+            if len(files) - suffix > prefix:
+                self.file_listbox.insert(prefix, *files[prefix:len(files) - suffix])
+
+        self.listbox_folder = self.selected_folder
+        self.listbox_files = list(files)
 
     def get_icon_for_file(self, filename):
-        ext = os.path.splitext(filename)[1].lower()
-        if ext in ['.mp3', '.wav']:
-            return self.icons.get("audio")
-        elif ext in ['.mp4', '.avi', '.mov']:
-            return self.icons.get("video")
-        elif ext == '.pdf':
-            return self.icons.get("pdf")
-        elif ext in ['.txt', '.csv']:
-            return self.icons.get("text")
-        elif ext in ['.jpg', '.jpeg', '.png']:
-            return self.icons.get("image")
-        return None
+        file_type = get_file_type(filename)
+        if file_type is None:
+            return None
+        if file_type not in self.icons:
+            self.icons[file_type] = self.load_icon(f"{file_type}_icon.png")
+        return self.icons[file_type]
 
     def select_files(self):
         files = filedialog.askopenfilenames()
@@ -255,6 +533,7 @@ class App(tk.Tk):
                     self.filepaths[self.selected_folder] = []
                 self.folders[self.selected_folder].append(filename)
                 self.filepaths[self.selected_folder].append(abs_path)
+                self.local_paths[(self.selected_folder, filename)] = abs_path
             self.update_file_listbox()
 
     def delete_selected_file(self):
@@ -278,7 +557,9 @@ class App(tk.Tk):
                     fp for fp in self.filepaths[self.selected_folder]
                     if os.path.basename(fp).lower() != filename.lower()
                 ]
+                self.local_paths.pop((self.selected_folder, filename), None)
                 self.update_file_listbox()
+                self.preview_token += 1
                 self.clear_preview()
 
     def open_selected_file(self, event):
@@ -286,7 +567,7 @@ class App(tk.Tk):
         if selection:
             index = selection[0]
             filename = self.file_listbox.get(index)
-            file_path = os.path.join(GLOBAL_DIRECTORY, filename)
+            file_path = self.resolve_file_path(filename)
 
             if os.path.isfile(file_path):
                 try:
@@ -299,8 +580,65 @@ class App(tk.Tk):
                 except Exception as e:
                     messagebox.showerror("Error", f"Could not open file: {e}")
 
+    def resolve_file_path(self, filename):
+        """Local path of a listed file, the one picked in select_files or else the copy in GLOBAL_DIRECTORY."""
+        default_path = os.path.join(GLOBAL_DIRECTORY, self.selected_folder, filename)
+        return self.local_paths.get((self.selected_folder, filename), default_path)
+
     def on_file_select(self, event):
-        pass
+        selection = self.file_listbox.curselection()
+        if not selection:
+            return
+
+        filename = self.file_listbox.get(selection[0])
+        path = self.resolve_file_path(filename)
+        self.preview_token += 1
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self.show_preview(filename, ("info", f"{filename}\nFile not available locally."))
+            return
+
+        preview = self.preview_cache.get(path, mtime)
+        if preview is not None:
+            self.show_preview(filename, preview)
+        else:
+            self.show_preview(filename, ("info", "Loading preview..."))
+            self.preview_worker.request(self.preview_token, path, mtime, get_file_type(filename))
+
+    def poll_previews(self):
+        """Shows the previews decoded by the worker, Tk widgets can only be used from this thread."""
+        try:
+            while True:
+                token, preview = self.preview_worker.results.get_nowait()
+                if token == self.preview_token:
+                    selection = self.file_listbox.curselection()
+                    filename = self.file_listbox.get(selection[0]) if selection else ""
+                    self.show_preview(filename, preview)
+        except queue.Empty:
+            pass
+        self.after(PREVIEW_POLL_MS, self.poll_previews)
+
+    def show_preview(self, filename, preview):
+        self.clear_preview()
+        kind, value = preview
+
+        # The preview widgets go right under the "Preview:" label, not after the buttons
+        if kind == "image":
+            self.preview_photo = ImageTk.PhotoImage(value)
+            self.preview_image_label.config(image=self.preview_photo)
+            self.preview_image_label.pack(after=self.preview_label, pady=5)
+            return
+
+        self.preview_text.insert('1.0', value)
+        self.preview_text.pack(after=self.preview_label, pady=5)
+
+        # Audio, video and PDF files show their type icon above the details
+        icon = self.get_icon_for_file(filename)
+        if kind == "info" and icon:
+            self.preview_image_label.config(image=icon)
+            self.preview_image_label.pack(after=self.preview_label, pady=5)
 
     def upload_files(self):
         if not self.filepaths[self.selected_folder]:
@@ -318,6 +656,7 @@ class App(tk.Tk):
         self.preview_text.pack_forget()
         self.preview_image_label.config(image='')
         self.preview_image_label.pack_forget()
+        self.preview_photo = None
 
 app = App()
 app.mainloop()
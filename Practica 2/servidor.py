@@ -3,6 +3,13 @@ import socket
 import signal
 import sys
 import shutil
+import zlib
+import hashlib
+import tempfile
+from transfer_stats import (
+    StatsRegistry, PacketTracer, EVENT_RECEIVE, EVENT_ACK_SENT, EVENT_DUPLICATE,
+    EVENT_OUT_OF_WINDOW, EVENT_CHECKSUM_ERROR,
+)
 
 # Server Configuration
 BUFFER_SIZE = 1024
@@ -12,14 +19,28 @@ END_SIGNAL = b"END"
 END_SESSION = b"END_SESSION"
 DELETE_REQUEST = b"DELETE"
 DELETE_FOLDER_REQUEST = b"DELETE_FOLDER"  # New command for folder deletion
+HEADER_SIZE = 12  # Seq (4) + fragment index (2) + number of fragments (2) + CRC32 (4)
+FILENAME_HEADER_SIZE = 8  # Seq #0 (4) + CRC32 of the seq and the filename (4)
+DIGEST_SIZE = hashlib.sha256().digest_size  # SHA-256 of the whole file, sent after END_SIGNAL
+FILE_OK = b"FILE_OK"
+FILE_CORRUPT = b"FILE_CORRUPT"
+STATS_REQUEST = b"STATS"  # Returns the live transfer statistics as JSON
+RECEIVE_TIMEOUT = 30  # Seconds without packets before a transfer is abandoned
+
+TRACE_FILE = None  # Path of the binary packet trace, None disables tracing
 
 SERVER_DIRECTORY = r"Poner la ruta de la carpeta donde se encuentre este documento"
 
 class Server:
-    def __init__(self, host='localhost', port=9000):
+    def __init__(self, host='localhost', port=9000, trace_path=TRACE_FILE):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_socket.bind((host, port))
         self.is_running = True
+        self.stats = StatsRegistry(WINDOW_SIZE)
+        self.tracer = PacketTracer(trace_path)
+        # Verdict of the last finished upload, repeated if the client resends its END
+        self.last_end_packet = None
+        self.last_verdict = None
         print(f"Server started on {host}:{port}")
 
         # Set up signal handling for graceful shutdown
@@ -29,7 +50,7 @@ class Server:
         while self.is_running:
             try:
                 # Receive the initial packet for filename and folder structure
-                data, client_address = self.server_socket.recvfrom(BUFFER_SIZE + 4)
+                data, client_address = self.server_socket.recvfrom(BUFFER_SIZE + FILENAME_HEADER_SIZE)
 
                 # Check for session end signal
                 if data == END_SESSION:
@@ -37,6 +58,15 @@ class Server:
                     self.shutdown(None, None)
                     break
 
+                if data == STATS_REQUEST:
+                    self.server_socket.sendto(self.stats.to_json(), client_address)
+                    continue
+
+                # The client resends END when it did not get the verdict, answer it again
+                if data == self.last_end_packet:
+                    self.server_socket.sendto(self.last_verdict, client_address)
+                    continue
+
                 # Handle delete requests or file reception
                 if data.startswith(DELETE_FOLDER_REQUEST):
                     folder_path = data[len(DELETE_FOLDER_REQUEST):].decode('utf-8').strip()
@@ -47,72 +77,193 @@ class Server:
                     self.handle_delete_request(filename, client_address, is_folder=False)
                     continue
 
-                # Extract sequence number and filepath from the packet
-                seq_num = int.from_bytes(data[:4], 'big')
-                filepath = data[4:].decode('utf-8')
-                full_path = os.path.join(SERVER_DIRECTORY, filepath)
-                
-                # Create necessary folder structure if specified in filepath
-                folder_path = os.path.dirname(full_path)
-                if folder_path and not os.path.exists(folder_path):
-                    os.makedirs(folder_path)
-
-                # Open the file for writing
-                with open(full_path, 'wb') as file:
-                    print(f"Receiving file: {full_path}")
-                    expected_seq_num = 1
-                    window = {}
-                    fragment_buffers = {}
-
-                    while True:
-                        data, client_address = self.server_socket.recvfrom(FRAGMENT_SIZE + 8)
-
-                        # If END_SIGNAL is received, finalize the file
-                        if data == END_SIGNAL:
-                            print(f"File {full_path} received successfully.")
-                            for seq in sorted(window.keys()):
-                                file.write(window[seq])
-                            break
-
-                        # Parse the sequence number and fragment data
-                        received_seq_num = int.from_bytes(data[:4], 'big')
-                        fragment_index = int.from_bytes(data[4:6], 'big')
-                        num_fragments = int.from_bytes(data[6:8], 'big')
-                        fragment_data = data[8:]
-
-                        print(f"Received packet: Seq #{received_seq_num}, Fragment #{fragment_index}/{num_fragments}")
-
-                        if expected_seq_num <= received_seq_num < expected_seq_num + WINDOW_SIZE:
-                            # Buffer the fragment data
-                            if received_seq_num not in fragment_buffers:
-                                fragment_buffers[received_seq_num] = [None] * num_fragments
-                            fragment_buffers[received_seq_num][fragment_index] = fragment_data
-
-                            # Check if all fragments of this packet have arrived
-                            if all(fragment is not None for fragment in fragment_buffers[received_seq_num]):
-                                # Reassemble the full packet
-                                full_packet_data = b''.join(fragment_buffers[received_seq_num])
-                                window[received_seq_num] = full_packet_data
-                                del fragment_buffers[received_seq_num]
-
-                                # Send acknowledgment
-                                ack_packet = received_seq_num.to_bytes(4, 'big')
-                                self.server_socket.sendto(ack_packet, client_address)
-                                print(f"Sent ACK for Seq #{received_seq_num}")
-
-                                # Write any in-sequence packets to the file
-                                while expected_seq_num in window:
-                                    file.write(window.pop(expected_seq_num))
-                                    expected_seq_num += 1
-                        else:
-                            # Resend last ACK if out-of-window packet received
-                            last_ack_packet = (expected_seq_num - 1).to_bytes(4, 'big')
-                            self.server_socket.sendto(last_ack_packet, client_address)
-                            print(f"Resent last ACK for Seq #{expected_seq_num - 1}")
+                # A transfer interrupted by a new filename packet hands that packet back
+                pending = (data, client_address)
+                while pending is not None:
+                    data, client_address = pending
+
+                    # Extract sequence number, checksum and filepath from the packet
+                    seq_num = int.from_bytes(data[:4], 'big')
+                    checksum = int.from_bytes(data[4:8], 'big')
+                    filepath_data = data[FILENAME_HEADER_SIZE:]
+
+                    # A corrupted filename would write to the wrong path, drop it
+                    if seq_num != 0 or zlib.crc32(data[:4] + filepath_data) != checksum:
+                        print(f"Invalid filename packet from {client_address}. Dropped.")
+                        break
+
+                    # The client waits for ACK #0 before sending any data
+                    self.send_ack(0, client_address)
+
+                    filepath = filepath_data.decode('utf-8')
+                    full_path = os.path.join(SERVER_DIRECTORY, filepath)
+
+                    # Create necessary folder structure if specified in filepath
+                    folder_path = os.path.dirname(full_path)
+                    if folder_path and not os.path.exists(folder_path):
+                        os.makedirs(folder_path)
+
+                    pending = self.receive_file(full_path, data)
 
             except Exception as e:
                 print(f"An error occurred during file reception: {e}")
 
+    def receive_file(self, full_path, filename_packet):
+        """Receives a file into a temporary file and replaces full_path only if its hash matches.
+
+        Returns the filename packet of the next upload and its address if the client started one before this one ended.
+        """
+        # A unique temporary name, so no existing file in the folder is ever truncated or deleted
+        temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), suffix=".part")
+        file_hash = hashlib.sha256()
+        verified = False
+        client_address = None
+        next_file_packet = None
+        timed_out = False
+        transfer = self.stats.start_transfer(full_path)
+
+        # Do not wait forever for a client that went away
+        self.server_socket.settimeout(RECEIVE_TIMEOUT)
+        try:
+            with os.fdopen(temp_fd, 'wb') as file:
+                print(f"Receiving file: {full_path}")
+                expected_seq_num = 1
+                window = {}
+                fragment_buffers = {}
+
+                while True:
+                    try:
+                        data, address = self.server_socket.recvfrom(BUFFER_SIZE + HEADER_SIZE)
+                    except socket.timeout:
+                        timed_out = True
+                        break
+
+                    # Stats can be queried from any address while a file is being received
+                    if data == STATS_REQUEST:
+                        self.server_socket.sendto(self.stats.to_json(), address)
+                        continue
+                    client_address = address
+
+                    # Data packets start at Seq #1, Seq #0 is a filename packet
+                    if int.from_bytes(data[:4], 'big') == 0:
+                        # The client resends the filename until it gets ACK #0, this is not a new upload
+                        if data == filename_packet and not window and not fragment_buffers and expected_seq_num == 1:
+                            self.send_ack(0, client_address)
+                            continue
+                        # Otherwise the client gave up on this transfer and started another
+                        next_file_packet = data
+                        break
+
+                    # If END_SIGNAL is received, finalize the file and compare the hashes
+                    if data.startswith(END_SIGNAL) and len(data) == len(END_SIGNAL) + DIGEST_SIZE:
+                        for seq in sorted(window.keys()):
+                            file.write(window[seq])
+                            file_hash.update(window[seq])
+                            transfer.count("bytes_written", len(window[seq]))
+                        verified = file_hash.digest() == data[len(END_SIGNAL):]
+                        self.last_end_packet = data
+                        break
+
+                    # Parse the sequence number, checksum and fragment data
+                    received_seq_num = int.from_bytes(data[:4], 'big')
+                    fragment_index = int.from_bytes(data[4:6], 'big')
+                    num_fragments = int.from_bytes(data[6:8], 'big')
+                    checksum = int.from_bytes(data[8:12], 'big')
+                    fragment_data = data[HEADER_SIZE:]
+                    transfer.count("packets_received")
+                    transfer.count("bytes_received", len(fragment_data))
+
+                    # Drop corrupted fragments, the client resends them after its timeout
+                    if zlib.crc32(data[:8] + fragment_data) != checksum or fragment_index >= num_fragments:
+                        print(f"Checksum mismatch for Seq #{received_seq_num}, Fragment #{fragment_index}. Dropped.")
+                        transfer.count("checksum_errors")
+                        self.tracer.record(EVENT_CHECKSUM_ERROR, received_seq_num, fragment_index, num_fragments, len(fragment_data))
+                        continue
+
+                    print(f"Received packet: Seq #{received_seq_num}, Fragment #{fragment_index}/{num_fragments}")
+                    self.tracer.record(EVENT_RECEIVE, received_seq_num, fragment_index, num_fragments, len(fragment_data))
+
+                    if expected_seq_num <= received_seq_num < expected_seq_num + WINDOW_SIZE:
+                        # Packets already reassembled but still waiting in the window
+                        if received_seq_num in window:
+                            transfer.count("duplicate_packets")
+                            self.tracer.record(EVENT_DUPLICATE, received_seq_num, fragment_index, num_fragments, len(fragment_data))
+
+                        # Buffer the fragment data
+                        if received_seq_num not in fragment_buffers:
+                            fragment_buffers[received_seq_num] = [None] * num_fragments
+                        fragment_buffers[received_seq_num][fragment_index] = fragment_data
+
+                        # Check if all fragments of this packet have arrived
+                        if all(fragment is not None for fragment in fragment_buffers[received_seq_num]):
+                            # Reassemble the full packet
+                            full_packet_data = b''.join(fragment_buffers[received_seq_num])
+                            window[received_seq_num] = full_packet_data
+                            del fragment_buffers[received_seq_num]
+
+                            # Send acknowledgment
+                            self.send_ack(received_seq_num, client_address)
+                            print(f"Sent ACK for Seq #{received_seq_num}")
+                            transfer.count("acks_sent")
+                            self.tracer.record(EVENT_ACK_SENT, received_seq_num)
+
+                            # Write any in-sequence packets to the file, hashing them on the way
+                            while expected_seq_num in window:
+                                packet_data = window.pop(expected_seq_num)
+                                file.write(packet_data)
+                                file_hash.update(packet_data)
+                                transfer.count("bytes_written", len(packet_data))
+                                expected_seq_num += 1
+
+                            # Packets received out of order that are still waiting for a gap
+                            transfer.window_occupancy.add(len(window))
+                    else:
+                        # Packets below the window were already written, the rest are too far ahead
+                        if received_seq_num < expected_seq_num:
+                            transfer.count("duplicate_packets")
+                            self.tracer.record(EVENT_DUPLICATE, received_seq_num, fragment_index, num_fragments, len(fragment_data))
+                            # Its ACK got lost, the client only frees the packets it got an ACK for
+                            ack_num = received_seq_num
+                        else:
+                            transfer.count("out_of_window_packets")
+                            self.tracer.record(EVENT_OUT_OF_WINDOW, received_seq_num, fragment_index, num_fragments, len(fragment_data))
+                            # Resend last ACK if out-of-window packet received
+                            ack_num = expected_seq_num - 1
+
+                        self.send_ack(ack_num, client_address)
+                        print(f"Resent ACK for Seq #{ack_num}")
+                        transfer.count("ack_resends")
+                        self.tracer.record(EVENT_ACK_SENT, ack_num)
+
+            if timed_out or next_file_packet is not None:
+                print(f"Transfer of {full_path} abandoned. The existing file was kept.")
+                return (next_file_packet, client_address) if next_file_packet is not None else None
+
+            if verified:
+                # mkstemp only lets the owner read the file, give it the usual permissions
+                os.chmod(temp_path, 0o644)
+                # Atomically replace the previous version of the file
+                os.replace(temp_path, full_path)
+                print(f"File {full_path} received successfully.")
+                self.last_verdict = FILE_OK
+            else:
+                print(f"File {full_path} failed the integrity check. The existing file was kept.")
+                self.last_verdict = FILE_CORRUPT
+            self.server_socket.sendto(self.last_verdict, client_address)
+            return None
+        finally:
+            self.server_socket.settimeout(None)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.stats.finish_transfer(transfer, verified)
+            print(f"Transfer stats: {transfer.summary()}")
+
+    def send_ack(self, seq_num, client_address):
+        """Sends the ACK for a sequence number followed by its CRC32 checksum."""
+        seq_bytes = seq_num.to_bytes(4, 'big')
+        ack_packet = seq_bytes + zlib.crc32(seq_bytes).to_bytes(4, 'big')
+        self.server_socket.sendto(ack_packet, client_address)
+
     def handle_delete_request(self, relative_path, client_address, is_folder):
         """Deletes a file or folder given a relative path from SERVER_DIRECTORY."""
         target_path = os.path.join(SERVER_DIRECTORY, relative_path)
@@ -140,6 +291,8 @@ class Server:
         print("\nShutting down server...")
         self.is_running = False
         self.server_socket.close()
+        self.tracer.close()
+        print(f"Global stats: {self.stats.totals.summary()}")
         sys.exit(0)
 
     def start(self):
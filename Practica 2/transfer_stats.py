@@ -0,0 +1,231 @@
+import bisect
+import json
+import struct
+import time
+from collections import deque
+
+# Counters tracked for every transfer (and added up in the global stats)
+COUNTERS = (
+    "packets_sent",
+    "packets_received",
+    "bytes_sent",
+    "bytes_received",
+    "bytes_written",
+    "acks_sent",
+    "acks_received",
+    "ack_resends",
+    "duplicate_acks",
+    "duplicate_packets",
+    "out_of_window_packets",
+    "checksum_errors",
+    "timeouts",
+    "retransmissions",
+)
+
+# Upper bounds of the histogram buckets, the last bucket takes everything above
+RTT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+RECENT_TRANSFERS = 5
+
+# Packet trace events
+EVENT_SEND = 1
+EVENT_RESEND = 2
+EVENT_RECEIVE = 3
+EVENT_ACK_SENT = 4
+EVENT_ACK_RECEIVED = 5
+EVENT_DUPLICATE = 6
+EVENT_OUT_OF_WINDOW = 7
+EVENT_TIMEOUT = 8
+EVENT_CHECKSUM_ERROR = 9
+
+EVENT_NAMES = {
+    EVENT_SEND: "send",
+    EVENT_RESEND: "resend",
+    EVENT_RECEIVE: "receive",
+    EVENT_ACK_SENT: "ack_sent",
+    EVENT_ACK_RECEIVED: "ack_received",
+    EVENT_DUPLICATE: "duplicate",
+    EVENT_OUT_OF_WINDOW: "out_of_window",
+    EVENT_TIMEOUT: "timeout",
+    EVENT_CHECKSUM_ERROR: "checksum_error",
+}
+
+# Trace record: timestamp, event, seq, fragment index, number of fragments, payload size
+TRACE_RECORD = struct.Struct(">dBIHHH")
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """Adds the samples of another histogram with the same buckets."""
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        return {
+            "bounds": list(self.bounds),
+            "counts": self.counts,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class TransferStats:
+    def __init__(self, name, window_size):
+        self.name = name
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.verified = None
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.rtt_ms = Histogram(RTT_BUCKETS_MS)
+        self.window_occupancy = Histogram(range(window_size + 1))
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+        return end_time - self.start_time
+
+    def to_dict(self):
+        elapsed = self.elapsed()
+        return {
+            "name": self.name,
+            "elapsed": elapsed,
+            "verified": self.verified,
+            "counters": self.counters,
+            "bytes_written_per_second": self.counters["bytes_written"] / elapsed if elapsed else 0,
+            "bytes_sent_per_second": self.counters["bytes_sent"] / elapsed if elapsed else 0,
+            "rtt_ms": self.rtt_ms.to_dict(),
+            "window_occupancy": self.window_occupancy.to_dict(),
+        }
+
+    def summary(self):
+        """One line summary printed when a transfer finishes."""
+        rtt = self.rtt_ms.to_dict()["mean"]
+        rtt_text = f"{rtt:.2f} ms" if rtt is not None else "n/a"
+        nonzero = ", ".join(f"{key}={value}" for key, value in self.counters.items() if value)
+        return f"{self.name}: {self.elapsed():.3f} s, mean RTT {rtt_text}, {nonzero}"
+
+
+class StatsRegistry:
+    """Keeps the transfer in progress, the last transfers and the global totals."""
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self.start_time = time.monotonic()
+        self.totals = TransferStats("global", window_size)
+        self.transfers_completed = 0
+        self.transfers_failed = 0
+        self.current = None
+        self.recent = deque(maxlen=RECENT_TRANSFERS)
+
+    def start_transfer(self, name):
+        self.current = TransferStats(name, self.window_size)
+        return self.current
+
+    def finish_transfer(self, transfer, verified):
+        transfer.end_time = time.monotonic()
+        transfer.verified = verified
+        if verified:
+            self.transfers_completed += 1
+        else:
+            self.transfers_failed += 1
+
+        for counter, value in transfer.counters.items():
+            self.totals.count(counter, value)
+        self.totals.rtt_ms.merge(transfer.rtt_ms)
+        self.totals.window_occupancy.merge(transfer.window_occupancy)
+
+        self.recent.append(transfer)
+        if self.current is transfer:
+            self.current = None
+
+    def to_dict(self):
+        totals = self.totals.to_dict()
+        totals["elapsed"] = time.monotonic() - self.start_time
+        totals["transfers_completed"] = self.transfers_completed
+        totals["transfers_failed"] = self.transfers_failed
+        return {
+            "global": totals,
+            "current": self.current.to_dict() if self.current else None,
+            "recent": [transfer.to_dict() for transfer in self.recent],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict()).encode('utf-8')
+
+
+class PacketTracer:
+    """Appends fixed size binary records of packet events to a file, does nothing without a path."""
+
+    def __init__(self, path=None):
+        self.file = open(path, 'ab') if path else None
+
+    def record(self, event, seq=0, fragment=0, num_fragments=0, size=0):
+        if self.file:
+            self.file.write(TRACE_RECORD.pack(time.time(), event, seq, fragment, num_fragments, size))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read_trace(path):
+    """Yields the records of a trace file as dictionaries for offline analysis."""
+    with open(path, 'rb') as trace_file:
+        while True:
+            record = trace_file.read(TRACE_RECORD.size)
+            if len(record) < TRACE_RECORD.size:
+                break
+            timestamp, event, seq, fragment, num_fragments, size = TRACE_RECORD.unpack(record)
+            yield {
+                "time": timestamp,
+                "event": EVENT_NAMES.get(event, event),
+                "seq": seq,
+                "fragment": fragment,
+                "num_fragments": num_fragments,
+                "size": size,
+            }
+
+
+def format_stats(stats):
+    """Formats the dictionary returned by StatsRegistry.to_dict for a message box."""
+    totals = stats["global"]
+    lines = [
+        f"Uptime: {totals['elapsed']:.1f} s",
+        f"Transfers completed: {totals['transfers_completed']}, failed: {totals['transfers_failed']}",
+    ]
+    lines += [f"{key}: {value}" for key, value in totals["counters"].items()]
+    rtt = totals["rtt_ms"]
+    if rtt["count"]:
+        lines.append(f"RTT: mean {rtt['mean']:.2f} ms, min {rtt['min']:.2f} ms, max {rtt['max']:.2f} ms")
+    window = totals["window_occupancy"]
+    if window["count"]:
+        lines.append(f"Window occupancy: mean {window['mean']:.2f}, max {window['max']}")
+    current = stats["current"]
+    if current:
+        lines.append(f"In progress: {current['name']} ({current['bytes_written_per_second']:.0f} B/s written)")
+    return "\n".join(lines)